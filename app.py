@@ -1,9 +1,9 @@
 from dotenv import load_dotenv, find_dotenv
 from error_dict import error_words
-from pydub import AudioSegment
 from google import genai
-from google.genai import types
-import re, os, openai
+from google.genai import errors, types
+from openai import AsyncOpenAI, DefaultAioHttpClient
+import asyncio, aiofiles, ahocorasick, aiohttp, blake3, functools, io, json, math, re, os, subprocess, tempfile, tenacity
 
 # Load variables from the nearest .env file (walking up directories if needed)
 load_dotenv(find_dotenv(), override=False)
@@ -12,155 +12,474 @@ GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
 if not GEMINI_API_KEY:
     raise RuntimeError("GEMINI_API_KEY not found. Make sure it's set in your .env file.")
 
+# 設定 USE_LOCAL_WHISPER=1 改用本地 faster-whisper 模型轉錄 (需另外安裝 faster-whisper)，否則使用 OpenAI Whisper API
+USE_LOCAL_WHISPER = os.getenv("USE_LOCAL_WHISPER") == "1"
+LOCAL_WHISPER_MODEL = os.getenv("LOCAL_WHISPER_MODEL", "large-v3")
+# 未設定時 GPU 用 int8_float16、CPU 用 int8；較新的硬體可自行嘗試 int8_bfloat16 等
+LOCAL_WHISPER_COMPUTE_TYPE = os.getenv("LOCAL_WHISPER_COMPUTE_TYPE")
+
+# 使用本地模型時不需要 OpenAI API key
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
-if not OPENAI_API_KEY:
+if not OPENAI_API_KEY and not USE_LOCAL_WHISPER:
     raise RuntimeError("OPENAI_API_KEY not found. Make sure it's set in your .env file.")
 
+# 同時處理的分段數量上限 (受 OpenAI / Gemini rate limit 限制)
+MAX_CONCURRENT = 5
+
+# 分段音檔預設只在記憶體中傳遞，設定 DEBUG_SAVE_AUDIO=1 時另存一份到 tmp 方便檢查
+DEBUG_SAVE_AUDIO = os.getenv("DEBUG_SAVE_AUDIO") == "1"
+
+# Whisper 結果以音檔內容 hash 快取，重跑同一個檔案 (例如只調整 Gemini prompt) 時不必重新轉錄
+CACHE_DIR = './cache'
+
+# 共用同一個 OpenAI client (aiohttp transport)，避免每次呼叫重建連線；使用本地模型時不建立
+openai_client = None
+if not USE_LOCAL_WHISPER:
+    openai_client = AsyncOpenAI(api_key=OPENAI_API_KEY, http_client=DefaultAioHttpClient())
+
+# 共用同一個 Gemini client，其 aiohttp session 會在所有分段間重複使用
+gemini_client = genai.Client(api_key=GEMINI_API_KEY)
+
+# Gemini 校正字幕用的設定，每次呼叫都相同，不需重建
+REFINE_CONFIG = types.GenerateContentConfig(
+    system_instruction="你是一位總體經濟研究員，並且將根據我提供的影片字幕內容以及我所列的規則進行審查並修飾。"
+)
+
+# Gemini 校正字幕的規則 prompt，每次呼叫都相同
+REFINE_PROMPT = (
+    "上面內容是繁體中文字幕，請遵守以下規則來修改：\n\n"
+    "1. 第一點最重要: 拜託不要自行合併多行字幕句子變成一段很長的字幕;換句換說，不要擅自合併多個時間軸成單一時間軸，因為這樣一行字幕會被拉得很長。一行字幕最多不要超過5秒\n"
+    "2. 第二點也很重要: 拜託不要更改每一行字幕的時間軸秒數，要跟原本的來源秒數一樣。\n"
+    "3. 一行一行的檢查並視情況做修改，如果有標點符號請拿掉。\n"
+    "4. 我們公司名稱是財經M平方，請判斷是否產生對的公司名稱。\n"
+    "5. 常出現的英文名字名單為: Rachel, Roger, Ryan, Vivianna, Dylan, Jat, Jason, Danny, Ralice"
+    "6. 然後字幕的內容是關於總體經濟的話題，因此會提到很多經濟、財經、股市、原物料、債券等等相關名詞。\n"
+    "7. 並且也包含各國央行鷹鴿派走向、商品以及指數的走勢、行情等等的分析。\n"
+    "8. 除此之外希望可以移除贅字如還有、然後、嗯嗯等等的。\n"
+    "9. 輸出的字幕檔的格式不要跑掉，例如原本句子之間的空行不要自行拿掉。\n"
+    "10. 結尾配樂的地方就不需要自行上字幕了\n"
+)
+
+# 有訪綱時加上第 11 點，訪綱檔接在 prompt 後面
+REFINE_PDF_PROMPT = REFINE_PROMPT + (
+    "11. 以下為這次音檔相關的訪綱，裡面的內容是這次字幕談到的相關內容以及人名，你可以用來參考。但這只能用來修正人名以及專有名詞，不要再對原來的文字語句及語法進行其他的修飾!!\n"
+)
+
+
+def get_audio_duration(input_path: str) -> float:
+    """Read the audio duration (seconds) with ffprobe, without decoding the file"""
+    result = subprocess.run(
+        ['ffprobe', '-v', 'error', '-show_format', '-print_format', 'json', input_path],
+        capture_output=True, text=True, check=True,
+    )
+    return float(json.loads(result.stdout)['format']['duration'])
+
 
-def split_audio(source: AudioSegment, length: int):
+def split_audio(duration: float, length: int):
     """
-    Split an AudioSegment into chunks.
+    Compute chunk ranges for an audio file.
 
     Parameters:
-        source (AudioSegment): the loaded audio file.
-        length (int): chunk length in milliseconds (e.g., 60_000 for 1 minute).
+        duration (float): total audio length in seconds.
+        length (int): chunk length in seconds (e.g., 60 for 1 minute).
 
     Returns:
-        list[AudioSegment]: list of audio chunks.
+        list[tuple[float, float]]: (start, end) of each chunk in seconds.
+        list[float]: start time of each chunk in seconds.
     """
-    start_times = []
-    chunks = []
-    for i in range(0, len(source), length):
-        chunks.append(source[i:i + length])
-        start_times.append(i / 1000)
-    return chunks, start_times
-
-
-def transcribe_audio(f_path):
-    """Transcribe audio using OpenAI Whisper"""
-    client = openai.OpenAI()
-
-    with open(f_path, "rb") as audio_file:
-        transcript = client.audio.transcriptions.create(
-            model="whisper-1",
-            file=audio_file,
-            language="zh",
-            response_format="srt"
-        )
+    ranges = [(i, min(i + length, duration)) for i in range(0, math.ceil(duration), length)]
+    start_times = [start for start, _ in ranges]
+    return ranges, start_times
+
+
+async def export_chunk(input_path: str, start: float, end: float) -> bytes:
+    """Cut [start, end) out of the mp3 with ffmpeg as 16 kHz mono Opus (what Whisper resamples to anyway)"""
+    proc = await asyncio.create_subprocess_exec(
+        'ffmpeg', '-v', 'error', '-ss', str(start), '-to', str(end), '-i', input_path,
+        '-vn', '-ac', '1', '-ar', '16000', '-c:a', 'libopus', '-b:a', '32k',
+        # bitexact: 固定 ogg serial number 等欄位，同一段音訊每次輸出的 bytes 相同，才能用 hash 快取
+        '-fflags', '+bitexact', '-flags:a', '+bitexact', '-f', 'ogg', 'pipe:1',
+        stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE,
+    )
+    stdout, stderr = await proc.communicate()
+    if proc.returncode != 0:
+        raise RuntimeError(f"ffmpeg 分割失敗 ({start}-{end}s): {stderr.decode(errors='ignore')}")
+    return stdout
+
+
+@functools.lru_cache(maxsize=1)
+def local_whisper_settings() -> tuple[str, str]:
+    """Resolve (device, compute_type) for the local faster-whisper model (cached)"""
+    import ctranslate2
+
+    has_cuda = ctranslate2.get_cuda_device_count() > 0
+    device = 'cuda' if has_cuda else 'cpu'
+    compute_type = LOCAL_WHISPER_COMPUTE_TYPE or ('int8_float16' if has_cuda else 'int8')
+    return device, compute_type
+
+
+@functools.lru_cache(maxsize=1)
+def load_local_whisper():
+    """Load the local faster-whisper batched pipeline on first use (cached)"""
+    from faster_whisper import BatchedInferencePipeline, WhisperModel
+
+    device, compute_type = local_whisper_settings()
+    model = WhisperModel(
+        LOCAL_WHISPER_MODEL,
+        device=device,
+        compute_type=compute_type,
+        cpu_threads=max(1, (os.cpu_count() or 2) // 2),
+        num_workers=2,
+    )
+    return BatchedInferencePipeline(model)
+
+
+def transcribe_audio_local(audio_bytes: bytes) -> str:
+    """Transcribe in-memory audio with the local faster-whisper model, returns SRT text"""
+    segments, _ = load_local_whisper().transcribe(io.BytesIO(audio_bytes), batch_size=16, language='zh')
+
+    # segments 是 generator，實際轉錄在迭代時才進行
+    buf = io.StringIO()
+    for idx, segment in enumerate(segments, start=1):
+        buf.write(f"{idx}\n{format_timestamp(round(segment.start * 1000))} --> "
+                  f"{format_timestamp(round(segment.end * 1000))}\n{segment.text.strip()}\n\n")
+    return buf.getvalue()
+
+
+async def transcribe_audio(audio_bytes: bytes, filename: str):
+    """Transcribe in-memory audio using OpenAI Whisper (or the local model when USE_LOCAL_WHISPER is set)"""
+    if USE_LOCAL_WHISPER:
+        # 本地模型為同步且吃 CPU/GPU，丟到 thread 避免卡住 event loop
+        return await asyncio.to_thread(transcribe_audio_local, audio_bytes)
+
+    transcript = await openai_client.audio.transcriptions.create(
+        model="whisper-1",
+        file=(filename, audio_bytes, "audio/ogg"),
+        language="zh",
+        response_format="srt"
+    )
 
     return transcript
 
 
+# Regex to match timestamp format: HH:MM:SS,mmm
+TIMESTAMP_RE = re.compile(r'(\d{2}):(\d{2}):(\d{2}),(\d{3})')
+
+
+def format_timestamp(total_ms: int) -> str:
+    """Format integer milliseconds as an SRT HH:MM:SS,mmm timestamp"""
+    return (f"{total_ms // 3600000:02d}:{total_ms // 60000 % 60:02d}:"
+            f"{total_ms // 1000 % 60:02d},{total_ms % 1000:03d}")
+
+
+def shift_timestamp(match, offset_ms: int) -> str:
+    """Shift a matched HH:MM:SS,mmm timestamp by offset_ms (integer math, no float rounding)"""
+    hours, minutes, seconds, milliseconds = map(int, match.groups())
+    total_ms = ((hours * 60 + minutes) * 60 + seconds) * 1000 + milliseconds + offset_ms
+
+    return format_timestamp(total_ms)
+
+
 def adjust_srt_timestamps(srt_content, offset_seconds):
     """Adjust SRT timestamps by adding offset"""
     if offset_seconds == 0:
         return srt_content
 
-    def adjust_timestamp(match):
-        timestamp = match.group(0)
-        # Parse timestamp: HH:MM:SS,mmm
-        time_parts = timestamp.replace(',', ':').split(':')
-        hours, minutes, seconds, milliseconds = map(int, time_parts)
+    offset_ms = round(offset_seconds * 1000)
+    return TIMESTAMP_RE.sub(lambda m: shift_timestamp(m, offset_ms), srt_content)
 
-        total_seconds = hours * 3600 + minutes * 60 + seconds + milliseconds / 1000.0
-        total_seconds += offset_seconds
 
-        new_hours = int(total_seconds // 3600)
-        new_minutes = int((total_seconds % 3600) // 60)
-        new_seconds = int(total_seconds % 60)
-        new_milliseconds = int((total_seconds % 1) * 1000)
-
-        return f"{new_hours:02d}:{new_minutes:02d}:{new_seconds:02d},{new_milliseconds:03d}"
-
-    # Regex to match timestamp format: HH:MM:SS,mmm
-    timestamp_pattern = r'\d{2}:\d{2}:\d{2},\d{3}'
-    return re.sub(timestamp_pattern, adjust_timestamp, srt_content)
+# Regex pieces for a single SRT block: index line, time range line, then one or more non-blank
+# text lines. A text line may not be the start of the next block, so a malformed block
+# (e.g. an empty-text cue) is skipped instead of being merged into its neighbour.
+SRT_TIME = r'\d{2}:\d{2}:\d{2},\d{3}'
+SRT_TEXT_LINE = rf'(?!\d+[ \t]*\n{SRT_TIME} --> )[^\n]*\S[^\n]*'
+BLOCK_RE = re.compile(
+    rf'^(\d+)[ \t]*\n({SRT_TIME} --> {SRT_TIME})[ \t]*\n({SRT_TEXT_LINE}(?:\n{SRT_TEXT_LINE})*)',
+    re.M,
+)
 
 
 def merge_srt_files(contents, start_times):
     """Merge multiple SRT contents with proper indexing and timestamps"""
-    merged_content = []
+    buf = io.StringIO()
     subtitle_index = 1
 
     for srt_content, start_offset in zip(contents, start_times):
+        # 統一換行符號 (CRLF / CR -> LF)，否則整段字幕會對不到
+        srt_content = srt_content.replace('\r\n', '\n').replace('\r', '\n')
+
         # Adjust timestamps for this chunk
-        adjusted_content = adjust_srt_timestamps(srt_content, start_offset)
+        adjusted_content = adjust_srt_timestamps(srt_content.strip(), start_offset)
 
-        # Split into blocks and reindex
-        blocks = adjusted_content.strip().split('\n\n')
+        # Reindex each block and write it straight into the buffer
+        for match in BLOCK_RE.finditer(adjusted_content):
+            buf.write(f"{subtitle_index}\n{match.group(2)}\n{match.group(3)}\n\n")
+            subtitle_index += 1
 
-        for block in blocks:
-            if block.strip():
-                lines = block.strip().split('\n')
-                if len(lines) >= 3:  # Valid SRT block
-                    # Replace the index with our sequential one
-                    lines[0] = str(subtitle_index)
-                    merged_content.append('\n'.join(lines))
-                    subtitle_index += 1
+    return buf.getvalue().rstrip()
 
-    return '\n\n'.join(merged_content)
 
+def build_error_automaton(words: dict):
+    """Build an Aho-Corasick automaton for a replacement dict"""
+    if not words:
+        return None
+    automaton = ahocorasick.Automaton()
+    for wrong, right in words.items():
+        automaton.add_word(wrong, (len(wrong), right))
+    automaton.make_automaton()
+    return automaton
 
-def apply_error_dictionary(text: str) -> str:
-    if not error_words:
+
+def replace_with_automaton(automaton, text: str) -> str:
+    """Replace all matches in one scan, taking the leftmost-longest match and skipping overlaps"""
+    if automaton is None:
         return text
-    for wrong, right in error_words.items():
-        # 全文直接替換，避免破壞時間戳，僅處理字幕文字行
-        text = text.replace(wrong, right)
-    return text
 
+    matches = sorted(
+        ((end - length + 1, length, right) for end, (length, right) in automaton.iter(text)),
+        key=lambda m: (m[0], -m[1]),
+    )
 
-def apply_error_dictionary2(text: str) -> str:
-    if not os.path.isfile('./error_dict.txt'):
+    parts = []
+    pos = 0
+    for start, length, right in matches:
+        if start < pos:
+            continue
+        parts.append(text[pos:start])
+        parts.append(right)
+        pos = start + length
+    parts.append(text[pos:])
+    return ''.join(parts)
+
+
+ERROR_DICT_PATH = './error_dict.txt'
+
+
+@functools.lru_cache(maxsize=1)
+def load_error_automaton():
+    """Build the automaton for error_dict.py on first use (cached)"""
+    return build_error_automaton(error_words)
+
+
+@functools.lru_cache(maxsize=1)
+def load_error_dict_file_automaton():
+    """Parse error_dict.txt (錯字=>正確字 per line) on first use and build its automaton (cached)"""
+    if not os.path.isfile(ERROR_DICT_PATH):
         raise RuntimeError("找無錯誤字典(error_dict.txt)")
 
-    with open('./error_dict.txt', 'r', encoding='utf-8') as f:
-        lines = f.readlines()
+    with open(ERROR_DICT_PATH, 'r', encoding='utf-8') as f:
+        words = dict(line.strip().split('=>', 1) for line in f if '=>' in line)
+    return build_error_automaton(words)
+
+
+def apply_error_dictionary(text: str) -> str:
+    # 全文直接替換，避免破壞時間戳，僅處理字幕文字行
+    return replace_with_automaton(load_error_automaton(), text)
 
-        for line in lines:
-            line = line.strip()
-            k, v = line.split('=>')
 
-            text = text.replace(k, v)
+def apply_error_dictionary2(text: str) -> str:
+    return replace_with_automaton(load_error_dict_file_automaton(), text)
+
+
+class GeminiRefineError(RuntimeError):
+    """Gemini returned no usable SRT (empty stream, safety block, or finish_reason other than STOP)"""
+
+
+def is_retryable_gemini_error(e: BaseException) -> bool:
+    """Only retry rate limits (429), server errors (5xx), timeouts, connection errors and unusable responses;
+    other 4xx are real bugs"""
+    if isinstance(e, errors.APIError):
+        return e.code == 429 or e.code >= 500
+    # aiohttp.ClientError: 串流中斷 (ClientPayloadError)、ServerDisconnectedError、ClientOSError 等連線問題
+    return isinstance(e, (asyncio.TimeoutError, aiohttp.ClientError, GeminiRefineError))
+
+
+@tenacity.retry(
+    wait=tenacity.wait_random_exponential(min=1, max=60),
+    stop=tenacity.stop_after_attempt(6),
+    retry=tenacity.retry_if_exception(is_retryable_gemini_error),
+    before_sleep=lambda rs: print(f"[Warn] Gemini refine failed: {rs.outcome.exception()}, will redo"),
+    reraise=True,
+)
+async def generate_refined_srt(contents: list) -> str:
+    """Stream one Gemini refine response (retried with backoff on 429 / 5xx / timeouts)"""
+    # 以串流方式接收，邊收邊寫入 buffer，不必等整份回應產生完
+    buf = io.StringIO()
+    finish_reason = None
+    async for chunk in await gemini_client.aio.models.generate_content_stream(
+            model="gemini-2.5-pro",
+            config=REFINE_CONFIG,
+            contents=contents):
+        if chunk.text:
+            buf.write(chunk.text)
+        if chunk.candidates and chunk.candidates[0].finish_reason:
+            finish_reason = chunk.candidates[0].finish_reason
+
+    # 被安全機制擋下、中途截斷或回傳空內容時不可當作成功，否則字幕會被靜默清空
+    if finish_reason != types.FinishReason.STOP:
+        raise GeminiRefineError(f"Gemini 回應未正常結束 (finish_reason={finish_reason})")
+    text = buf.getvalue()
+    if not BLOCK_RE.search(text):
+        raise GeminiRefineError("Gemini 回應中沒有任何字幕區塊")
 
     return text
 
-def refine_srt_with_gemini(gemini_client: genai.Client, srt_text: str, pdf_file: types.File=None) -> str:
-
-    prompt = (
-        "上面內容是繁體中文字幕，請遵守以下規則來修改：\n\n"
-        "1. 第一點最重要: 拜託不要自行合併多行字幕句子變成一段很長的字幕;換句換說，不要擅自合併多個時間軸成單一時間軸，因為這樣一行字幕會被拉得很長。一行字幕最多不要超過5秒\n"
-        "2. 第二點也很重要: 拜託不要更改每一行字幕的時間軸秒數，要跟原本的來源秒數一樣。\n"
-        "3. 一行一行的檢查並視情況做修改，如果有標點符號請拿掉。\n"
-        "4. 我們公司名稱是財經M平方，請判斷是否產生對的公司名稱。\n"
-        "5. 常出現的英文名字名單為: Rachel, Roger, Ryan, Vivianna, Dylan, Jat, Jason, Danny, Ralice"
-        "6. 然後字幕的內容是關於總體經濟的話題，因此會提到很多經濟、財經、股市、原物料、債券等等相關名詞。\n"
-        "7. 並且也包含各國央行鷹鴿派走向、商品以及指數的走勢、行情等等的分析。\n"
-        "8. 除此之外希望可以移除贅字如還有、然後、嗯嗯等等的。\n"
-        "9. 輸出的字幕檔的格式不要跑掉，例如原本句子之間的空行不要自行拿掉。\n"
-        "10. 結尾配樂的地方就不需要自行上字幕了\n"
-    )
 
+async def refine_srt_with_gemini(srt_text: str, pdf_file: types.File=None) -> str:
+    # 字幕只透過 Part 傳送一次，prompt 以「上面內容」引用，不要再把 srt_text 串進 prompt (會讓 token 數加倍)
+    # contents 只在這裡建一次 (字幕只 encode 一次)，重試時直接重用
     contents: list[types.Part | str | types.File] = [
-        genai.types.Part.from_bytes(
-            data=bytes(srt_text, 'utf-8'),
+        types.Part.from_bytes(
+            data=srt_text.encode('utf-8'),
             mime_type='text/plain',
         ),
-        prompt,
+        REFINE_PROMPT if pdf_file is None else REFINE_PDF_PROMPT,
     ]
 
     if pdf_file is not None:
-        prompt += "11. 以下為這次音檔相關的訪綱，裡面的內容是這次字幕談到的相關內容以及人名，你可以用來參考。但這只能用來修正人名以及專有名詞，不要再對原來的文字語句及語法進行其他的修飾!!\n"
         contents.append(pdf_file)
 
-    response = gemini_client.models.generate_content(
-        model="gemini-2.5-pro",
-        config=types.GenerateContentConfig(
-            system_instruction="你是一位總體經濟研究員，並且將根據我提供的影片字幕內容以及我所列的規則進行審查並修飾。"
-        ),
-        contents=contents)
+    return await generate_refined_srt(contents)
+
+
+async def whisper_chunk(idx: int, input_path: str, chunk_range: tuple[float, float], total: int,
+                        encode_semaphore: asyncio.Semaphore, semaphore: asyncio.Semaphore, queue: asyncio.Queue):
+    """Export and transcribe a single chunk, then hand (idx, srt) to the refine stage"""
+    # 分割不佔 API 額度，只依 CPU 核心數限制同時編碼的數量，讓編碼與 API 呼叫重疊
+    filename = f"chunk_{idx + 1}.ogg"
+    async with encode_semaphore:
+        audio_bytes = await export_chunk(input_path, *chunk_range)
+    if DEBUG_SAVE_AUDIO:
+        async with aiofiles.open(f"./tmp/{filename}", 'wb') as f:
+            await f.write(audio_bytes)
+
+    # 本地模型與 API 的結果分開快取，本地模型再依模型名稱與量化方式區分
+    cache_name = blake3.blake3(audio_bytes).hexdigest()
+    if USE_LOCAL_WHISPER:
+        model_tag = re.sub(r'[^\w.-]', '_', f"{LOCAL_WHISPER_MODEL}.{local_whisper_settings()[1]}")
+        cache_name += f'.local.{model_tag}'
+    cache_name += '.srt'
+    cache_path = os.path.join(CACHE_DIR, cache_name)
+    if os.path.isfile(cache_path):
+        print(f'[{idx + 1}] 使用快取字幕檔 {cache_path}')
+        async with aiofiles.open(cache_path, 'r', encoding='utf-8') as f:
+            srt_content = await f.read()
+    else:
+        async with semaphore:
+            print(f"Processing chunk {idx + 1}/{total}")
+
+            backend = f'本地 faster-whisper ({LOCAL_WHISPER_MODEL})' if USE_LOCAL_WHISPER else 'OpenAI'
+            print(f'[{idx + 1}] {backend} 產生字幕檔')
+            srt_content = await transcribe_audio(audio_bytes, filename)
+
+        # 空結果不快取；先寫到暫存檔再 os.replace，中途中斷也不會留下寫一半的快取
+        if srt_content.strip():
+            os.makedirs(CACHE_DIR, exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(dir=CACHE_DIR, suffix='.tmp')
+            os.close(fd)
+            try:
+                async with aiofiles.open(tmp_path, 'w', encoding='utf-8') as f:
+                    await f.write(srt_content)
+                os.replace(tmp_path, cache_path)
+            except BaseException:
+                os.remove(tmp_path)
+                raise
+
+    # 備存個別srt檔案到tmp
+    print(f'[{idx + 1}] 備存個別srt檔案到tmp')
+    async with aiofiles.open(f"./tmp/chunk_{idx + 1}.srt", 'w', encoding='utf-8') as f:
+        await f.write(srt_content)
+
+    # 先做本地名詞/錯字替換
+    print(f'[{idx + 1}] 先做本地名詞/錯字替換')
+    srt_content = apply_error_dictionary2(srt_content)
+
+    await queue.put((idx, srt_content))
+
+
+async def refine_chunk(idx: int, srt_content: str, semaphore: asyncio.Semaphore, pdf_file: types.File = None):
+    """Refine a single chunk with Gemini (retried with backoff), falling back to the local version
+    only after transient errors run out of retries"""
+    async with semaphore:
+        try:
+            print(f'[{idx + 1}] 再交給 Gemini 校正文字')
+            fined_srt_content = await refine_srt_with_gemini(srt_text=srt_content, pdf_file=pdf_file)
+        except Exception as e:
+            # 非暫時性錯誤 (模型名稱錯誤、400、403 等) 代表程式或設定有問題，直接拋出不要掩蓋
+            if not is_retryable_gemini_error(e):
+                raise
+            # 暫時性錯誤重試用盡後，保留本地修正版，並輸出警告
+            print(f"[Warn] Gemini refine failed: {e}, keep local version for chunk {idx + 1}")
+            return srt_content
+
+    # 備存校正後的字幕檔至tmp
+    print(f'[{idx + 1}] 備存結合的字幕檔至tmp')
+    fined_srt_filename = f"./tmp/fined_{idx + 1}.srt"
+    async with aiofiles.open(fined_srt_filename, 'w', encoding='utf-8') as f:
+        await f.write(fined_srt_content)
+
+    return fined_srt_content
+
+
+async def refine_worker(queue: asyncio.Queue, raw_srt_contents: list, srt_contents: list,
+                        pdf_file: types.File = None):
+    """Pull transcribed chunks off the queue and fan them out to Gemini until a None sentinel arrives"""
+    semaphore = asyncio.Semaphore(MAX_CONCURRENT)
+
+    async def run(idx, srt_content):
+        srt_contents[idx] = await refine_chunk(idx, srt_content, semaphore, pdf_file)
+
+    # TaskGroup: worker 被取消或任一分段失敗時，已送出的 Gemini 任務也會一併取消並等待結束
+    async with asyncio.TaskGroup() as tg:
+        while True:
+            item = await queue.get()
+            if item is None:
+                break
+            idx, srt_content = item
+            raw_srt_contents[idx] = srt_content
+            tg.create_task(run(idx, srt_content))
+
+
+async def transcribe_chunks(input_path: str, chunk_ranges, pdf_file: types.File = None):
+    """
+    Run Whisper and Gemini as a two-stage pipeline, keeping results in chunk order.
+
+    Whisper results are pushed onto a queue as soon as each chunk finishes, so Gemini
+    refinement of earlier chunks overlaps with transcription of later ones.
+    """
+    encode_semaphore = asyncio.Semaphore(os.cpu_count() or 1)
+    # 本地模型一次只跑一段 (模型內部已做 batch)，避免多段同時搶 GPU 記憶體
+    whisper_semaphore = asyncio.Semaphore(1 if USE_LOCAL_WHISPER else MAX_CONCURRENT)
+    queue = asyncio.Queue(maxsize=MAX_CONCURRENT)
+    raw_srt_contents = [None] * len(chunk_ranges)
+
+    if USE_LOCAL_WHISPER:
+        # 先在 thread 內解析本地模型設定 (import ctranslate2、偵測 CUDA)，結果會被快取，
+        # 之後各分段組快取檔名時就不會在 event loop 上做同步的 import / 偵測
+        await asyncio.to_thread(local_whisper_settings)
+    srt_contents = [None] * len(chunk_ranges)
 
-    return response.text
+    # 兩個階段都放在 TaskGroup 內，任一分段失敗時其餘 Whisper / Gemini 任務都會被取消並等待結束，
+    # 離開這裡之後不會有還在跑的 API 呼叫
+    async with asyncio.TaskGroup() as tg:
+        tg.create_task(refine_worker(queue, raw_srt_contents, srt_contents, pdf_file))
+
+        async with asyncio.TaskGroup() as whisper_tg:
+            for i, r in enumerate(chunk_ranges):
+                whisper_tg.create_task(
+                    whisper_chunk(i, input_path, r, len(chunk_ranges), encode_semaphore, whisper_semaphore, queue))
+
+        await queue.put(None)
+    return raw_srt_contents, srt_contents
+
+
+async def aclose_clients():
+    """Close the shared OpenAI / Gemini clients; call once from the entry point before its event loop ends"""
+    # 關閉 aiohttp session，避免程式結束時出現 unclosed session 警告
+    if openai_client is not None:
+        await openai_client.close()
+    await gemini_client.aio.aclose()
 
 
 if __name__ == '__main__':
@@ -172,12 +491,10 @@ if __name__ == '__main__':
     input_pdf = '1204.pdf'
     input_pdf_path = './input_files/' + input_pdf
 
-    # set gemini client
-    client = genai.Client(api_key=GEMINI_API_KEY)
     pdf_ref = None
     if os.path.isfile(input_pdf_path):
         print("載入訪綱")
-        pdf_ref = client.files.upload(file=input_pdf_path)
+        pdf_ref = gemini_client.files.upload(file=input_pdf_path)
 
     if not os.path.isfile(input_path):
         raise RuntimeError("MP3檔案不存在")
@@ -185,54 +502,19 @@ if __name__ == '__main__':
     # 分割mp3檔，設定每分鐘做分割
     print('分割mp3檔案')
     mins = 15
-    chunk_length = 60 * 1000 * mins # 分鐘
-
-    audio = AudioSegment.from_mp3(input_path)
-    audio_slices, start_secs = split_audio(source=audio, length=chunk_length)
-
-    raw_srt_contents = []
-    srt_contents = []
-
-    # 先產生字幕再結合
-    for idx, audio_slice in enumerate(audio_slices):
-        print(f"Processing chunk {idx + 1}/{len(audio_slices)}")
-
-        file_path = f"./tmp/chunk_{idx + 1}.mp3"
-        audio_slice.export(file_path, format="mp3")
-
-        print('OpenAI 產生字幕檔')
-        srt_content = transcribe_audio(file_path)
-
-        # 備存個別srt檔案到tmp
-        print('備存個別srt檔案到tmp')
-        with open(f"./tmp/chunk_{idx + 1}.srt", 'w', encoding='utf-8') as f:
-            f.write(srt_content)
-
-             # 先做本地名詞/錯字替換
-            print('先做本地名詞/錯字替換')
-            srt_content = apply_error_dictionary2(srt_content)
-
-        raw_srt_contents.append(srt_content)
-
-        # 再交給 Gemini 校正文字
-        is_pass = False
-        while not is_pass:
-            try:
-                print('再交給 Gemini 校正文字')
-                srt_content = refine_srt_with_gemini(gemini_client=client, srt_text=srt_content, pdf_file=pdf_ref)
+    chunk_length = 60 * mins # 秒
 
-                # 備存校正後的字幕檔至tmp
-                print('備存結合的字幕檔至tmp')
-                fined_srt_filename = f"./tmp/fined_{idx + 1}.srt"
-                with open(fined_srt_filename, '+w', encoding='utf-8') as f:
-                    f.write(srt_content)
+    duration = get_audio_duration(input_path)
+    chunk_ranges, start_secs = split_audio(duration=duration, length=chunk_length)
 
-                is_pass = True
-            except Exception as e:
-                # 若 Gemini 呼叫失敗，保留本地修正版，並輸出警告
-                print(f"[Warn] Gemini refine failed: {e}, will redo")
+    # 先產生字幕再結合 (各分段同時處理)
+    async def run_pipeline():
+        try:
+            return await transcribe_chunks(input_path, chunk_ranges, pdf_file=pdf_ref)
+        finally:
+            await aclose_clients()
 
-        srt_contents.append(srt_content)
+    raw_srt_contents, srt_contents = asyncio.run(run_pipeline())
 
     # Merge SRT contents
     print('結合未修飾字幕檔')
@@ -245,7 +527,7 @@ if __name__ == '__main__':
         raw_final_srt = merge_srt_files(raw_srt_contents, start_secs)
 
     # Write a final SRT file
-    with open(raw_srt_filename, '+w', encoding='utf-8') as f:
+    with open(raw_srt_filename, 'w', encoding='utf-8') as f:
         f.write(raw_final_srt)
 
     print('結合已修飾字幕檔')
@@ -258,7 +540,7 @@ if __name__ == '__main__':
         final_srt = merge_srt_files(srt_contents, start_secs)
 
     # Write a final SRT file
-    with open(srt_filename, '+w', encoding='utf-8') as f:
+    with open(srt_filename, 'w', encoding='utf-8') as f:
         f.write(final_srt)
 
     print(f'完成輸出, 未修飾字幕路徑: {raw_srt_filename}, 已修飾字幕路徑: {srt_filename}')
@@ -1,19 +1,28 @@
-from app import refine_srt_with_gemini
+from app import aclose_clients, refine_srt_with_gemini
+import asyncio
 
 input_file = './output_files/1009_Podcast.srt'
 
 with open(input_file, 'r', encoding='utf-8') as f:
     final_srt = f.read()
 
+
+async def refine(srt_text):
+    try:
+        return await refine_srt_with_gemini(srt_text=srt_text)
+    finally:
+        await aclose_clients()
+
+
 # 再交給 Gemini 清理贅字與公司名校正
 try:
     print('再交給 Gemini 清理贅字與公司名校正')
-    final_srt = refine_srt_with_gemini(final_srt)
+    final_srt = asyncio.run(refine(final_srt))
 except Exception as e:
     # 若 Gemini 呼叫失敗，保留本地修正版，並輸出警告
     print(f"[Warn] Gemini refine failed: {e}")
 
 # Write a final SRT file
 tmp_file = './tmp/test1_output.srt'
-with open(tmp_file, '+w', encoding='utf-8') as f:
+with open(tmp_file, 'w', encoding='utf-8') as f:
     f.write(final_srt)
\ No newline at end of file
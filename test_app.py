@@ -0,0 +1,82 @@
+import os
+
+# app 在 import 時會檢查 API key，這裡的測試不會呼叫任何 API
+os.environ.setdefault("GEMINI_API_KEY", "test")
+os.environ.setdefault("OPENAI_API_KEY", "test")
+
+from app import TIMESTAMP_RE, adjust_srt_timestamps, build_error_automaton, merge_srt_files, replace_with_automaton, \
+    shift_timestamp
+
+
+def test_merge_srt_files_reindexes_and_offsets_chunks():
+    first = "1\n00:00:01,000 --> 00:00:02,000\n你好\n\n2\n00:00:03,000 --> 00:00:04,000\n世界\n第二行\n\n"
+    second = "1\n00:00:00,500 --> 00:00:01,000\n下一段\n"
+
+    assert merge_srt_files([first, second], [0, 900.0]) == (
+        "1\n00:00:01,000 --> 00:00:02,000\n你好\n\n"
+        "2\n00:00:03,000 --> 00:00:04,000\n世界\n第二行\n\n"
+        "3\n00:15:00,500 --> 00:15:01,000\n下一段"
+    )
+
+
+def test_merge_srt_files_handles_crlf():
+    srt = "1\r\n00:00:00,000 --> 00:00:01,000\r\na\r\n\r\n2\r\n00:00:01,000 --> 00:00:02,000\r\nb\r\n"
+
+    assert merge_srt_files([srt], [0]) == (
+        "1\n00:00:00,000 --> 00:00:01,000\na\n\n"
+        "2\n00:00:01,000 --> 00:00:02,000\nb"
+    )
+
+
+def test_merge_srt_files_drops_empty_text_cue():
+    srt = ("1\n00:00:00,000 --> 00:00:01,000\n\n"
+           "2\n00:00:01,000 --> 00:00:02,000\nx\n\n"
+           "3\n00:00:02,000 --> 00:00:03,000\ny\n")
+
+    assert merge_srt_files([srt], [0]) == (
+        "1\n00:00:01,000 --> 00:00:02,000\nx\n\n"
+        "2\n00:00:02,000 --> 00:00:03,000\ny"
+    )
+
+
+def test_merge_srt_files_splits_cues_without_blank_line():
+    srt = ("1\n00:00:00,000 --> 00:00:01,000\na\n"
+           "2\n00:00:01,000 --> 00:00:02,000\nb\n\n\n"
+           "3\n00:00:02,000 --> 00:00:03,000\nc\n")
+
+    assert merge_srt_files([srt], [0]) == (
+        "1\n00:00:00,000 --> 00:00:01,000\na\n\n"
+        "2\n00:00:01,000 --> 00:00:02,000\nb\n\n"
+        "3\n00:00:02,000 --> 00:00:03,000\nc"
+    )
+
+
+def test_replace_with_automaton_prefers_leftmost_longest():
+    automaton = build_error_automaton({"臺灣": "台灣", "臺灣價權指數": "台灣加權指數", "研究人": "研究員", "研究人員": "研究員"})
+
+    assert replace_with_automaton(automaton, "研究人員說臺灣價權指數和臺灣") == "研究員說台灣加權指數和台灣"
+
+
+def test_replace_with_automaton_does_not_rescan_replacements():
+    automaton = build_error_automaton({"MN": "MM", "MM會員": "錯誤"})
+
+    assert replace_with_automaton(automaton, "MN會員") == "MM會員"
+
+
+def test_replace_with_automaton_without_dictionary_returns_text():
+    assert replace_with_automaton(build_error_automaton({}), "原文") == "原文"
+
+
+def test_shift_timestamp_carries_into_hours():
+    match = TIMESTAMP_RE.search("00:14:59,999")
+
+    assert shift_timestamp(match, 2700 * 1000) == "00:59:59,999"
+    assert shift_timestamp(match, 2700 * 1000 + 1) == "01:00:00,000"
+
+
+def test_adjust_srt_timestamps_keeps_milliseconds_exact():
+    srt = "1\n00:00:00,001 --> 00:00:02,005\nhi"
+
+    # 舊的 float 算法會把 ,001 算成 ,000、,005 算成 ,004
+    assert adjust_srt_timestamps(srt, 900.0) == "1\n00:15:00,001 --> 00:15:02,005\nhi"
+    assert adjust_srt_timestamps(srt, 0) == srt